@@ -1,22 +1,41 @@
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
 from pathlib import Path
-import json
-import shutil
+import asyncio
+import os
+import re
+import orjson
+import threading
+import time
+import aiofiles
 import google.generativeai as genai
+import torch
 
 # ----------------------------
 # Import RAG and Tracker components
 # ----------------------------
 from backend.rag import (
+    close_search_batcher,
+    extend_vector_store,
     get_embedding_model,
     ingest,
-    retrieve_context
+    index_layout,
+    ingest_single_pdf,
+    load_vector_store,
+    retrieve_context,
+    save_vector_store,
+    Snapshot
 )
 from backend.config import GEMINI_API_KEY
-from backend.progress_tracker import get_student_profile, update_student_profile
+from backend.progress_tracker import (
+    get_student_profile,
+    save_student_profiles,
+    update_student_profile
+)
 
 # ----------------------------
 # Gemini API setup
@@ -24,6 +43,46 @@ from backend.progress_tracker import get_student_profile, update_student_profile
 genai.configure(api_key=GEMINI_API_KEY)
 model_generation = genai.GenerativeModel("gemini-2.5-flash")
 
+# Matches an LLM response wrapped in a ```json ... ``` (or bare ```) fence
+_JSON_FENCE = re.compile(r"^```(?:json)?\s*(.*?)\s*```\s*$", re.DOTALL)
+
+
+class _AsyncLRUCache:
+    """
+    Bounded LRU memo for async LLM calls. Stores one shared asyncio.Task per
+    key, so concurrent identical requests make a single Gemini call; failed
+    calls are evicted instead of cached. With ttl (seconds), entries expire
+    that long after the call started.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._tasks = OrderedDict()  # key -> (task, created_at)
+
+    async def get(self, key, make_coro):
+        entry = self._tasks.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+            del self._tasks[key]
+            entry = None
+
+        if entry is None:
+            task = asyncio.ensure_future(make_coro())
+            self._tasks[key] = (task, time.monotonic())
+            if len(self._tasks) > self.maxsize:
+                self._tasks.popitem(last=False)
+        else:
+            task = entry[0]
+            self._tasks.move_to_end(key)
+
+        try:
+            # Shield so one cancelled request doesn't cancel the shared call
+            return await asyncio.shield(task)
+        except Exception:
+            if self._tasks.get(key, (None,))[0] is task:
+                del self._tasks[key]
+            raise
+
 
 # ----------------------------
 # Initialize RAG system
@@ -32,22 +91,72 @@ DATA_DIR = Path(__file__).parent / "data"
 if not DATA_DIR.exists():
     DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-# Global variables for vector store
+# Leave half the cores to FAISS's OpenMP pool to avoid oversubscription
+torch.set_num_threads(max(1, (os.cpu_count() or 1) // 2))
 embedding_model = get_embedding_model()
-index = None
-texts = []
+# Pay the first-encode thread-pool/allocator warmup here, not on a request
+embedding_model.encode(["warmup"], convert_to_numpy=True, show_progress_bar=False)
 
-def rebuild_vector_store():
-    """Rebuild the vector store from all PDFs in data directory."""
-    global index, texts
+# Global variables for vector store. Handlers read _snapshot once per request;
+# writers replace it wholesale (a single, atomic name rebind).
+_snapshot: Snapshot | None = None
+# Serializes writers of _snapshot (rebuilds and incremental uploads)
+_index_lock = threading.Lock()
+
+def rebuild_vector_store(force=False):
+    """
+    Load the persisted vector store if it is up to date, otherwise rebuild it
+    from all PDFs in data directory. Pass force=True to always rebuild.
+    """
+    with _index_lock:
+        return _rebuild_vector_store_locked(force)
+
+def _rebuild_vector_store_locked(force):
+    global _snapshot
     try:
+        stored = None if force else load_vector_store(str(DATA_DIR))
+        if stored is not None:
+            _snapshot = Snapshot(*stored)
+            print(f"RAG system loaded persisted index with {len(_snapshot.texts)} chunks.")
+            return True
+
         index, texts, chunk_count = ingest(str(DATA_DIR), embedding_model)
+        save_vector_store(index, texts, str(DATA_DIR))
+        _snapshot = Snapshot(index, texts)
         print(f"RAG system initialized successfully with {chunk_count} chunks from {len(list(DATA_DIR.glob('*.pdf')))} PDF(s).")
         return True
     except Exception as e:
         print(f"ERROR initializing RAG. Error: {e}")
         return False
 
+def add_pdf_to_vector_store(pdf_path):
+    """
+    Encode a single new PDF and append it to the vector store, leaving
+    already-indexed PDFs untouched. Falls back to a full rebuild when there
+    is no usable index to extend or the corpus needs a different layout.
+    """
+    global _snapshot
+    with _index_lock:
+        snap = _snapshot
+        if snap is None or not snap.index.is_trained or snap.index.ntotal == 0:
+            return _rebuild_vector_store_locked(force=True)
+        try:
+            new_texts, new_embeddings = ingest_single_pdf(pdf_path, embedding_model)
+            n_total = snap.index.ntotal + len(new_texts)
+            if index_layout(n_total) != index_layout(snap.index.ntotal):
+                # The corpus outgrew its index layout (e.g. Flat -> HNSW32,SQ8).
+                # Every PDF is in the embedding cache now, so this is only a
+                # vstack and train/add, not a re-encode.
+                return _rebuild_vector_store_locked(force=True)
+            index, texts = extend_vector_store(snap.index, snap.texts, new_texts, new_embeddings)
+            save_vector_store(index, texts, str(DATA_DIR))
+            _snapshot = Snapshot(index, texts)
+            print(f"Added {len(new_texts)} chunks from {Path(pdf_path).name}; vector store now has {len(texts)} chunks.")
+            return True
+        except Exception as e:
+            print(f"ERROR adding {Path(pdf_path).name} to RAG. Error: {e}")
+            return False
+
 # Initialize on startup
 rebuild_vector_store()
 
@@ -55,7 +164,14 @@ rebuild_vector_store()
 # ----------------------------
 # FastAPI App
 # ----------------------------
-app = FastAPI(title="Simplified AI Tutor Backend", version="2.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Stop the FAISS search batcher and persist student progress on shutdown
+    await close_search_batcher()
+    save_student_profiles()
+
+app = FastAPI(title="Simplified AI Tutor Backend", version="2.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware, allow_origins=["*"], allow_credentials=True, 
@@ -105,9 +221,11 @@ class UploadResponse(BaseModel):
 # ----------------------------
 # 0. Upload PDF Endpoint
 # ----------------------------
+UPLOAD_CHUNK_SIZE = 1 << 20  # Stream uploads to disk 1 MiB at a time
+
 @app.post("/upload", response_model=UploadResponse)
 async def upload_pdf(file: UploadFile = File(...)):
-    """Upload a PDF file and rebuild the vector store."""
+    """Upload a PDF file and add it to the vector store."""
     if not file.filename.endswith('.pdf'):
         return UploadResponse(
             success=False,
@@ -119,24 +237,30 @@ async def upload_pdf(file: UploadFile = File(...)):
     try:
         # Save uploaded file
         file_path = DATA_DIR / file.filename
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        replaces_existing = file_path.exists()
+        async with aiofiles.open(file_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
         
-        # Rebuild vector store with all PDFs
-        success = rebuild_vector_store()
+        # Only encode the new PDF; a replaced PDF needs a full rebuild so
+        # its old chunks are dropped
+        if replaces_existing:
+            success = await asyncio.to_thread(rebuild_vector_store, True)
+        else:
+            success = await asyncio.to_thread(add_pdf_to_vector_store, file_path)
         
         if success:
-            chunk_count = len(texts)
+            chunk_count = len(_snapshot.texts)
             return UploadResponse(
                 success=True,
-                message=f"PDF '{file.filename}' uploaded successfully. Vector store rebuilt with {chunk_count} chunks.",
+                message=f"PDF '{file.filename}' uploaded successfully. Vector store now has {chunk_count} chunks.",
                 filename=file.filename,
                 chunk_count=chunk_count
             )
         else:
             return UploadResponse(
                 success=False,
-                message="PDF uploaded but failed to rebuild vector store.",
+                message="PDF uploaded but failed to update vector store.",
                 filename=file.filename,
                 chunk_count=0
             )
@@ -153,15 +277,16 @@ async def upload_pdf(file: UploadFile = File(...)):
 # 1. Answer Endpoint (Direct RAG Retrieval)
 # ----------------------------
 @app.post("/ask_answer", response_model=AnswerResponse)
-def ask_answer(payload: TutorRequest):
+async def ask_answer(payload: TutorRequest):
     question = payload.input_text
     
-    if index is None or len(texts) == 0:
+    snap = _snapshot
+    if snap is None or len(snap.texts) == 0:
         return AnswerResponse(
             natural_language_response="No PDF documents are available. Please upload PDF files first using the upload feature."
         )
     
-    context = retrieve_context(question, embedding_model, index, texts)
+    context = await retrieve_context(question, embedding_model, snap.index, snap.texts)
     
     tutor_prompt = f"""
     You are a friendly and **concise** AI Tutor. Your answer must be **direct and brief**.
@@ -174,7 +299,7 @@ def ask_answer(payload: TutorRequest):
     Provide a clear, brief, and friendly explanation as a tutor.
     """
     
-    response = model_generation.generate_content(tutor_prompt)
+    response = await model_generation.generate_content_async(tutor_prompt)
     
     return AnswerResponse(natural_language_response=response.text)
 
@@ -182,30 +307,18 @@ def ask_answer(payload: TutorRequest):
 # ----------------------------
 # 2. Quiz Generation Endpoint (Direct LLM Call)
 # ----------------------------
-@app.post("/quiz_generate", response_model=QuizGenerateResponse)
-def quiz_generate(payload: TutorRequest):
-    topic = payload.input_text
-    student_id = payload.student_id
+# Quiz difficulty adapts to the student's current strength on the topic
+_DIFFICULTY_BY_STRENGTH = {"strong": "hard", "weak": "easy"}
 
-    # Get student profile to determine adaptive difficulty (still useful!)
-    profile = get_student_profile(student_id)
-    current_strength = profile["topics"].get(topic, {}).get("strength", "unknown")
-    difficulty = "medium"
-    if current_strength == "strong": difficulty = "hard"
-    if current_strength == "weak": difficulty = "easy"
-    
-    if index is None or len(texts) == 0:
-        return QuizGenerateResponse(
-            topic=topic,
-            questions=[QuizQuestion(
-                q="No PDF documents are available. Please upload PDF files first.",
-                options=["Upload PDFs to continue"],
-                correct_answer=""
-            )]
-        )
-    
-    context = retrieve_context(topic, embedding_model, index, texts)
 
+# Identical quiz requests reuse generated questions for a few minutes only,
+# so retakes later in a session get fresh questions
+QUIZ_CACHE_TTL_SECONDS = 5 * 60
+_quiz_cache = _AsyncLRUCache(maxsize=256, ttl=QUIZ_CACHE_TTL_SECONDS)
+
+
+async def _generate_quiz(topic: str, difficulty: str, context: str) -> tuple:
+    """Generate and parse quiz questions. Raises on bad LLM output."""
     quiz_prompt = f"""
     Create EXACTLY 3 {difficulty} MCQs about the topic '{topic}' based ONLY on the context.
     The questions MUST be challenging but directly answerable from the context.
@@ -224,24 +337,56 @@ def quiz_generate(payload: TutorRequest):
     """
     
     # Final fix: Rely on the strict prompt and manual cleaning (most compatible method)
-    quiz_resp = model_generation.generate_content(quiz_prompt)
+    quiz_resp = await model_generation.generate_content_async(quiz_prompt)
 
     try:
-        # Rely on manual string cleaning to extract JSON (needed when no config is passed)
+        # Strip an optional markdown fence to extract JSON (needed when no config is passed)
         cleaned = quiz_resp.text.strip()
-        if cleaned.startswith("```json"):
-            cleaned = cleaned.replace("```json", "").replace("```", "")
-        elif cleaned.startswith("```"):
-            cleaned = cleaned.replace("```", "")
-            
-        quiz_json = json.loads(cleaned)
-        questions = [QuizQuestion(**q) for q in quiz_json.get("questions", [])]
-        return QuizGenerateResponse(topic=topic, questions=questions)
+        m = _JSON_FENCE.match(cleaned)
+        cleaned = m.group(1) if m else cleaned
+
+        quiz_json = orjson.loads(cleaned)
+        return tuple(QuizQuestion(**q) for q in quiz_json.get("questions", []))
+    except Exception:
+        # Log the raw response text for debugging
+        print(f"Raw LLM Response: {quiz_resp.text}")
+        raise
+
+
+@app.post("/quiz_generate", response_model=QuizGenerateResponse)
+async def quiz_generate(payload: TutorRequest):
+    topic = payload.input_text
+    student_id = payload.student_id
+
+    # Get student profile to determine adaptive difficulty (still useful!)
+    profile = get_student_profile(student_id)
+    current_strength = profile["topics"].get(topic, {}).get("strength", "unknown")
+    difficulty = _DIFFICULTY_BY_STRENGTH.get(current_strength, "medium")
+    
+    snap = _snapshot
+    if snap is None or len(snap.texts) == 0:
+        return QuizGenerateResponse(
+            topic=topic,
+            questions=[QuizQuestion(
+                q="No PDF documents are available. Please upload PDF files first.",
+                options=["Upload PDFs to continue"],
+                correct_answer=""
+            )]
+        )
+    
+    context = await retrieve_context(topic, embedding_model, snap.index, snap.texts)
+
+    try:
+        # Cached per (topic, difficulty, context): repeat requests during a
+        # session skip Gemini, and the retrieved context changes with the corpus
+        questions = await _quiz_cache.get(
+            (topic, difficulty, context),
+            lambda: _generate_quiz(topic, difficulty, context)
+        )
+        return QuizGenerateResponse(topic=topic, questions=list(questions))
         
     except Exception as e:
         print(f"Quiz generation failed: {e}")
-        # Log the raw response text for debugging
-        print(f"Raw LLM Response: {quiz_resp.text}")
         return QuizGenerateResponse(
             topic=topic,
             questions=[QuizQuestion(q=f"Quiz failed: LLM output error. Details: {e}", options=["Try another topic"], correct_answer="")]
@@ -252,7 +397,7 @@ def quiz_generate(payload: TutorRequest):
 # 3. Quiz Submission Endpoint (Tracking/Feedback)
 # ----------------------------
 @app.post("/quiz_submit", response_model=AgentResponse)
-def submit_quiz(payload: QuizSubmission):
+async def submit_quiz(payload: QuizSubmission):
     
     correct_count = 0
     total_count = len(payload.submission)
@@ -261,8 +406,9 @@ def submit_quiz(payload: QuizSubmission):
         if str(q_data.get("student_answer")).upper() == str(q_data.get("correct_answer")).upper():
             correct_count += 1
             
-    # 1. Update Progress Tracker
-    update_student_profile(
+    # 1. Update Progress Tracker (persists to disk, so keep it off the event loop)
+    await asyncio.to_thread(
+        update_student_profile,
         student_id=payload.student_id, 
         topic=payload.topic, 
         correct_count=correct_count, 
@@ -286,39 +432,45 @@ def submit_quiz(payload: QuizSubmission):
 # ----------------------------
 # 4. Progress Report Endpoint
 # ----------------------------
+_progress_summary_cache = _AsyncLRUCache(maxsize=256)
+
+
+async def _progress_summary(weakest_topic: str, strengths: tuple) -> str:
+    """Generate the friendly one-sentence progress summary."""
+    summary_prompt = f"""
+    A student's topic strengths are: {dict(strengths)}. Their weakest topic is '{weakest_topic}'.
+    Write a friendly, one-sentence summary of their progress that encourages them to focus on '{weakest_topic}'.
+    Output the sentence ONLY.
+    """
+    response = await model_generation.generate_content_async(summary_prompt)
+    return response.text.strip()
+
+
 @app.get("/progress/{student_id}", response_model=ProgressResponse)
-def get_progress(student_id: str = "default_student"):
+async def get_progress(student_id: str = "default_student"):
     profile = get_student_profile(student_id)
-    
-    # Use LLM to generate natural language recommendation
-    recommendation_prompt = f"""
-    Analyze the student's progress: {json.dumps(profile["topics"])}. Recommend the single best next topic.
-    Recommendation Goal: Focus on the weakest area.
-    
-    Output JSON ONLY:
-    {{ "recommendation": "Topic name", "summary": "A friendly, one-sentence summary." }}
-    """
-    
-    try:
-        rec_resp = model_generation.generate_content(recommendation_prompt)
-        
-        rec_data_clean = rec_resp.text.strip()
-        if rec_data_clean.startswith("```json"):
-            rec_data_clean = rec_data_clean.replace("```json", "").replace("```", "")
-        elif rec_data_clean.startswith("```"):
-            rec_data_clean = rec_data_clean.replace("```", "")
-
-        rec_data = json.loads(rec_data_clean)
-        recommendation = rec_data.get("recommendation", "Reviewing fundamental concepts.")
-        summary = rec_data.get("summary", "Keep up the good work!")
-        
-    except Exception:
+    topics = profile["topics"]
+
+    if not topics:
         recommendation = "Reviewing fundamental concepts."
-        summary = "Could not generate personalized recommendation."
+        summary = "Take a quiz to start tracking your progress!"
+    else:
+        # Recommend the weakest area directly; the LLM only phrases the summary
+        recommendation = min(topics.items(), key=lambda kv: kv[1]["accuracy"])[0]
+        strengths = tuple(sorted((topic, data["strength"]) for topic, data in topics.items()))
+        try:
+            # Cached per (weakest topic, topic strengths): most dashboard hits
+            # repeat a state the student was already in
+            summary = await _progress_summary_cache.get(
+                (recommendation, strengths),
+                lambda: _progress_summary(recommendation, strengths)
+            )
+        except Exception:
+            summary = "Could not generate personalized recommendation."
 
     return ProgressResponse(
         student_id=student_id,
-        progress=profile["topics"],
+        progress=topics,
         agent_recommendation=recommendation,
         natural_language_summary=summary
-    )
\ No newline at end of file
+    )
@@ -0,0 +1,39 @@
+# backend/pdf_loader.py
+# PDF parsing and chunking. Kept free of torch / FAISS / sentence-transformers
+# imports so spawned parse workers start in well under a second.
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+import fitz
+
+
+# Text splitting. Larger chunks with a small overlap mean fewer embeddings
+# and index vectors per PDF; check retrieval quality before shrinking
+# the overlap further.
+CHUNK_SIZE = 700
+CHUNK_OVERLAP = 80
+
+
+def load_pdf_chunks(pdf_path):
+    """Load and chunk a single PDF file."""
+    with fitz.open(pdf_path) as doc:
+        pages = [
+            Document(page_content=page.get_text("text"), metadata={"source": pdf_path, "page": i})
+            for i, page in enumerate(doc)
+        ]
+
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP
+    )
+
+    chunks = splitter.split_documents(pages)
+    return chunks
+
+
+def count_pages(pdf_path):
+    """Return the number of pages in a PDF (0 if it can't be opened)."""
+    try:
+        with fitz.open(pdf_path) as doc:
+            return doc.page_count
+    except Exception:
+        return 0
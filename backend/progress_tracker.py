@@ -1,6 +1,15 @@
 # backend/progress_tracker.py
+import copy
+import os
+import threading
+from pathlib import Path
 
-# In-memory database for student progress (simulating a DB/JSON file)
+import orjson
+
+# Student progress is kept in memory and persisted to this JSON file
+PROFILES_PATH = Path(__file__).parent / "data" / "profiles.json"
+
+# In-memory database for student progress
 STUDENT_PROFILES = {
     "default_student": {
         "topics": {
@@ -13,60 +22,93 @@ STUDENT_PROFILES = {
     }
 }
 
+# Guards STUDENT_PROFILES against concurrent requests; re-entrant because
+# update_student_profile calls get_student_profile while holding it.
+_profiles_lock = threading.RLock()
+# Serializes writes of PROFILES_PATH (and its shared temp file)
+_save_lock = threading.Lock()
+
+def load_student_profiles():
+    """Loads persisted student profiles, if any, into STUDENT_PROFILES."""
+    if PROFILES_PATH.exists():
+        with _profiles_lock:
+            STUDENT_PROFILES.update(orjson.loads(PROFILES_PATH.read_bytes()))
+
+def save_student_profiles():
+    """Writes STUDENT_PROFILES to disk (atomically, via a temp file)."""
+    # Snapshot and write under _save_lock so concurrent saves land in order;
+    # _profiles_lock is only held for the in-memory snapshot
+    with _save_lock:
+        with _profiles_lock:
+            data = orjson.dumps(STUDENT_PROFILES, option=orjson.OPT_SERIALIZE_NUMPY)
+        PROFILES_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = PROFILES_PATH.with_suffix(".tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, PROFILES_PATH)
+
 def get_student_profile(student_id: str = "default_student"):
     """
     Fetches the progress profile for a student.
     Initializes a new profile if the ID doesn't exist.
+    Returns a copy taken under the lock, so callers can read it while
+    updates run concurrently; write changes back via update_student_profile.
     """
-    if student_id not in STUDENT_PROFILES:
-        # Create a deep copy of the default profile for a new student
-        STUDENT_PROFILES[student_id] = {
-            "topics": {
-                "AI": {"accuracy": 0, "strength": "unknown"},
-                "Probability": {"accuracy": 0, "strength": "unknown"},
-                "Physics - Mechanics": {"accuracy": 0, "strength": "unknown"},
-            },
-            "last_interaction": None
-        }
+    with _profiles_lock:
+        if student_id not in STUDENT_PROFILES:
+            # Create a deep copy of the default profile for a new student
+            STUDENT_PROFILES[student_id] = {
+                "topics": {
+                    "AI": {"accuracy": 0, "strength": "unknown"},
+                    "Probability": {"accuracy": 0, "strength": "unknown"},
+                    "Physics - Mechanics": {"accuracy": 0, "strength": "unknown"},
+                },
+                "last_interaction": None
+            }
         
-    return STUDENT_PROFILES[student_id]
+        return copy.deepcopy(STUDENT_PROFILES[student_id])
 
 def update_student_profile(student_id: str, topic: str, correct_count: int, total_count: int):
     """
     Updates a student's topic strength based on quiz results.
     """
-    profile = get_student_profile(student_id)
+    with _profiles_lock:
+        profile = get_student_profile(student_id)
     
-    # Ensure the topic exists in the profile
-    if topic not in profile["topics"]:
-        profile["topics"][topic] = {"accuracy": 0, "strength": "unknown"}
+        # Ensure the topic exists in the profile
+        if topic not in profile["topics"]:
+            profile["topics"][topic] = {"accuracy": 0, "strength": "unknown"}
     
-    current_topic = profile["topics"][topic]
+        current_topic = profile["topics"][topic]
     
-    # Calculate performance from the latest quiz
-    latest_performance = correct_count / total_count
+        # Calculate performance from the latest quiz
+        latest_performance = correct_count / total_count
     
-    # Simple weighted average update (70% weight to current average, 30% to new performance)
-    if current_topic["strength"] == "unknown":
-        new_accuracy = latest_performance * 100
-    else:
-        new_accuracy = (current_topic["accuracy"] * 0.7) + (latest_performance * 100 * 0.3)
+        # Simple weighted average update (70% weight to current average, 30% to new performance)
+        if current_topic["strength"] == "unknown":
+            new_accuracy = latest_performance * 100
+        else:
+            new_accuracy = (current_topic["accuracy"] * 0.7) + (latest_performance * 100 * 0.3)
         
-    new_accuracy = round(min(new_accuracy, 100)) # Cap at 100
+        new_accuracy = round(min(new_accuracy, 100)) # Cap at 100
     
-    if new_accuracy >= 80:
-        strength = "strong"
-    elif new_accuracy >= 50:
-        strength = "average"
-    else:
-        strength = "weak"
+        if new_accuracy >= 80:
+            strength = "strong"
+        elif new_accuracy >= 50:
+            strength = "average"
+        else:
+            strength = "weak"
 
-    profile["topics"][topic] = {
-        "accuracy": new_accuracy,
-        "strength": strength
-    }
-    profile["last_interaction"] = f"quiz_completed_on_{topic}"
+        profile["topics"][topic] = {
+            "accuracy": new_accuracy,
+            "strength": strength
+        }
+        profile["last_interaction"] = f"quiz_completed_on_{topic}"
     
-    # Update the global store (for in-memory tracking)
-    STUDENT_PROFILES[student_id] = profile
-    return profile
\ No newline at end of file
+        # Update the global store
+        STUDENT_PROFILES[student_id] = profile
+
+    # Persist outside _profiles_lock (save takes _save_lock first)
+    save_student_profiles()
+    return profile
+
+load_student_profiles()
\ No newline at end of file
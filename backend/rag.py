@@ -1,72 +1,353 @@
 import os
+import asyncio
+import hashlib
+import multiprocessing
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
+import torch
 
+from backend.pdf_loader import CHUNK_OVERLAP, CHUNK_SIZE, count_pages, load_pdf_chunks
 
-def load_pdf_chunks(pdf_path):
-    """Load and chunk a single PDF file."""
-    loader = PyPDFLoader(pdf_path)
-    pages = loader.load()
 
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=300,
-        chunk_overlap=40
-    )
+# FAISS index layout. Corpora below FLAT_INDEX_THRESHOLD chunks use an exact
+# Flat index; larger ones use INDEX_FACTORY_STRING (e.g. "IVF256,PQ16" once
+# the corpus grows past ~10k chunks). All indexes use inner product over
+# L2-normalized embeddings, i.e. cosine similarity. SQ8 stores vectors as
+# int8 codes (4x smaller than float32); its per-dimension ranges are trained
+# on the corpus, so it is only used once there is enough data to train on.
+INDEX_FACTORY_STRING = "HNSW32,SQ8"
+FLAT_INDEX_THRESHOLD = 1000
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
 
-    chunks = splitter.split_documents(pages)
-    return chunks
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_BATCH_SIZE = 128
+QUERY_CACHE_SIZE = 1024
 
+# Concurrent queries are coalesced into one index.search call of up to
+# SEARCH_MAX_BATCH queries, waiting at most SEARCH_MAX_WAIT seconds to fill it
+SEARCH_MAX_BATCH = 16
+SEARCH_MAX_WAIT = 0.010
 
-def load_all_pdfs_from_directory(data_dir):
-    """Load and chunk all PDF files from a directory."""
+# Uncached PDFs are parsed in worker processes only when they add up to at
+# least this many pages: spawning a worker (~0.5 s) costs more than parsing
+# a few hundred pages with PyMuPDF
+PARALLEL_PARSE_MIN_PAGES = 500
+
+# Per-PDF chunk/embedding cache, stored next to the PDFs and keyed by file
+# content plus the chunking/model settings. Bump _CACHE_VERSION whenever PDF
+# text extraction changes.
+CACHE_DIR_NAME = ".cache"
+_CACHE_VERSION = 2
+_CACHE_TAG = f"v{_CACHE_VERSION}:{EMBEDDING_MODEL_NAME}:{CHUNK_SIZE}:{CHUNK_OVERLAP}"
+
+# Persisted vector store, memory-mapped on startup while it is up to date.
+# The texts file doubles as the commit marker and is always written last.
+INDEX_FILE_NAME = "index.faiss"
+INDEX_TEXTS_FILE_NAME = "index_texts.pkl"
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    An immutable (index, texts) pair. Writers publish a new Snapshot instead
+    of mutating the current one, so readers always see a consistent view
+    without taking a lock.
+    """
+    index: faiss.Index
+    texts: np.ndarray
+
+    def __post_init__(self):
+        self.texts.flags.writeable = False
+
+
+def _embed_cache_path(pdf_path):
+    """Return the cache file for a PDF, keyed by a hash of its contents."""
+    pdf_path = Path(pdf_path)
+    digest = hashlib.sha1(f"{_CACHE_TAG}:".encode())
+    digest.update(pdf_path.read_bytes())
+    return pdf_path.parent / CACHE_DIR_NAME / f"{digest.hexdigest()}.npz"
+
+
+def embed_texts(texts, model):
+    """Encode texts into L2-normalized float32 embeddings."""
+    # FAISS needs float32 even when the model runs in FP16
+    return model.encode(
+        texts,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=False
+    ).astype(np.float32)
+
+
+def _read_embed_cache(cache_path):
+    """Return cached (texts, embeddings) for a PDF, or None on a cache miss."""
+    if not cache_path.exists():
+        return None
+    try:
+        with np.load(cache_path) as cached:
+            return cached["texts"].tolist(), cached["embeddings"]
+    except Exception as e:
+        # An unreadable entry is re-encoded and overwritten, never fatal
+        print(f"Ignoring corrupt cache file {cache_path.name}: {e}")
+        return None
+
+
+def _write_embed_cache(cache_path, texts, embeddings):
+    """Store a PDF's chunk texts and embeddings in the cache."""
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temp file and rename so a crash never leaves a truncated entry
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, texts=np.array(texts, dtype=str), embeddings=embeddings)
+    os.replace(tmp_path, cache_path)
+
+
+def _empty_embeddings(model):
+    return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+
+def ingest_single_pdf(pdf_path, model):
+    """
+    Load the chunks and embeddings of a single PDF, encoding it only
+    if it is not already in the on-disk cache.
+    Returns (texts, embeddings)
+    """
+    cache_path = _embed_cache_path(pdf_path)
+    cached = _read_embed_cache(cache_path)
+    if cached is not None:
+        return cached
+
+    chunks = load_pdf_chunks(str(pdf_path))
+    texts = [c.page_content for c in chunks]
+    embeddings = embed_texts(texts, model) if texts else _empty_embeddings(model)
+
+    _write_embed_cache(cache_path, texts, embeddings)
+    return texts, embeddings
+
+
+def _parse_pdfs(pdf_files):
+    """
+    Load and chunk PDFs, in parallel worker processes when there is more
+    than one and they total at least PARALLEL_PARSE_MIN_PAGES pages.
+    Returns {pdf_path: texts} for the PDFs that parsed successfully.
+    """
+    parsed = {}
+    if len(pdf_files) == 1 or sum(count_pages(str(p)) for p in pdf_files) < PARALLEL_PARSE_MIN_PAGES:
+        for pdf_path in pdf_files:
+            try:
+                parsed[pdf_path] = [c.page_content for c in load_pdf_chunks(str(pdf_path))]
+            except Exception as e:
+                print(f"Error loading {pdf_path.name}: {e}")
+        return parsed
+
+    # Spawn fresh workers: forking a process that already runs torch, FAISS
+    # OpenMP and the search thread pool can deadlock the children. Workers
+    # only import the light backend.pdf_loader module.
+    max_workers = min(len(pdf_files), os.cpu_count() or 1)
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+        futures = {
+            pdf_path: executor.submit(load_pdf_chunks, str(pdf_path))
+            for pdf_path in pdf_files
+        }
+        for pdf_path, future in futures.items():
+            try:
+                parsed[pdf_path] = [c.page_content for c in future.result()]
+            except Exception as e:
+                print(f"Error loading {pdf_path.name}: {e}")
+    return parsed
+
+
+def load_all_pdfs_from_directory(data_dir, model):
+    """
+    Load the chunks and embeddings of all PDF files from a directory.
+    Returns a list of (texts, embeddings), one entry per PDF.
+    """
     data_path = Path(data_dir)
     if not data_path.exists():
         data_path.mkdir(parents=True, exist_ok=True)
         return []
     
-    all_chunks = []
+    documents = {}
+    cache_paths = {}
     pdf_files = list(data_path.glob("*.pdf"))
     
     for pdf_path in pdf_files:
         try:
-            chunks = load_pdf_chunks(str(pdf_path))
-            all_chunks.extend(chunks)
-            print(f"Loaded {len(chunks)} chunks from {pdf_path.name}")
+            cache_paths[pdf_path] = _embed_cache_path(pdf_path)
+            cached = _read_embed_cache(cache_paths[pdf_path])
         except Exception as e:
             print(f"Error loading {pdf_path.name}: {e}")
+            continue
+        if cached is not None:
+            documents[pdf_path] = cached
+
+    # Parse uncached PDFs in parallel, then encode all their chunks in one pass
+    uncached = [p for p in cache_paths if p not in documents]
+    parsed = _parse_pdfs(uncached) if uncached else {}
+    all_texts = [text for texts in parsed.values() for text in texts]
+    if all_texts:
+        all_embeddings = embed_texts(all_texts, model)
+    else:
+        all_embeddings = _empty_embeddings(model)
+
+    offset = 0
+    for pdf_path, texts in parsed.items():
+        embeddings = all_embeddings[offset:offset + len(texts)]
+        offset += len(texts)
+        _write_embed_cache(cache_paths[pdf_path], texts, embeddings)
+        documents[pdf_path] = (texts, embeddings)
+
+    for pdf_path in pdf_files:
+        if pdf_path in documents:
+            print(f"Loaded {len(documents[pdf_path][0])} chunks from {pdf_path.name}")
+
+    # Drop cache entries whose source PDF was removed or changed
+    live_cache_files = {cache_path.name for cache_path in cache_paths.values()}
+    cache_dir = data_path / CACHE_DIR_NAME
+    if cache_dir.exists():
+        for cache_file in cache_dir.glob("*.npz"):
+            if cache_file.name not in live_cache_files:
+                cache_file.unlink()
     
-    return all_chunks
+    return [documents[p] for p in pdf_files if p in documents]
 
 
 def get_embedding_model():
-    """Get or initialize the embedding model."""
-    return SentenceTransformer("all-MiniLM-L6-v2")
+    """Get or initialize the embedding model (FP16 on GPU when available)."""
+    if torch.cuda.is_available():
+        return SentenceTransformer(EMBEDDING_MODEL_NAME, device="cuda").half()
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+
+def index_layout(n_vectors):
+    """Return the factory string used for a corpus of n_vectors chunks."""
+    if n_vectors < FLAT_INDEX_THRESHOLD:
+        return "Flat"
+    return INDEX_FACTORY_STRING
+
+
+def create_index(dim, n_vectors=0):
+    """Create an empty FAISS index sized for a corpus of n_vectors chunks."""
+    index = faiss.index_factory(dim, index_layout(n_vectors), faiss.METRIC_INNER_PRODUCT)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    return index
 
 
-def build_vector_store(chunks, model):
-    """Build a FAISS vector store from document chunks."""
-    if not chunks:
+def build_vector_store(documents, model):
+    """Build a FAISS vector store from per-PDF (texts, embeddings) pairs."""
+    if model is None:
+        model = get_embedding_model()
+    dim = model.get_sentence_embedding_dimension()
+
+    # Chunk texts are kept as an object array so retrieval can gather
+    # top-k hits with a single fancy-indexing call
+    texts = np.array([text for doc_texts, _ in documents for text in doc_texts], dtype=object)
+    if len(texts) == 0:
         # Return empty index if no chunks
-        if model is None:
-            model = get_embedding_model()
-        dim = model.get_sentence_embedding_dimension()
-        index = faiss.IndexFlatL2(dim)
-        return index, []
-    
-    texts = [c.page_content for c in chunks]
-    embeddings = model.encode(texts, convert_to_numpy=True)
+        index = create_index(dim)
+        return index, texts
+
+    embeddings = np.vstack([doc_embeddings for _, doc_embeddings in documents])
 
-    dim = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dim)
+    index = create_index(dim, len(embeddings))
+    if not index.is_trained:
+        # IVF / PQ layouts need a training pass before vectors can be added
+        index.train(embeddings)
     index.add(embeddings)
 
     return index, texts
 
 
+def extend_vector_store(index, texts, new_texts, new_embeddings):
+    """
+    Return a copy of the vector store with new chunks appended.
+    The index is copied rather than mutated, so searches already in flight
+    keep the old one. Callers must rebuild instead when the layout changes
+    (see index_layout).
+    """
+    # A serialize round-trip gives an owned copy. faiss.clone_index is not
+    # enough: on a memory-mapped index it still views the mapped codes, and
+    # add() then aborts the process.
+    new_index = faiss.deserialize_index(faiss.serialize_index(index))
+    new_index.add(new_embeddings)
+    return new_index, np.concatenate([texts, np.array(new_texts, dtype=object)])
+
+
+def _pdf_sources(data_path):
+    return sorted(p.name for p in data_path.glob("*.pdf"))
+
+
+def save_vector_store(index, texts, data_dir):
+    """Persist the FAISS index and its chunk texts next to the PDFs."""
+    data_path = Path(data_dir)
+    index_path = data_path / INDEX_FILE_NAME
+    texts_path = data_path / INDEX_TEXTS_FILE_NAME
+
+    # Write to temp files and rename so other workers never see partial files.
+    # The index goes first: the texts/metadata file is the commit marker, so a
+    # crash between the two renames leaves metadata that no longer matches.
+    tmp_index_path = index_path.with_suffix(".tmp")
+    faiss.write_index(index, str(tmp_index_path))
+    os.replace(tmp_index_path, index_path)
+
+    tmp_texts_path = texts_path.with_suffix(".tmp")
+    with open(tmp_texts_path, "wb") as f:
+        pickle.dump({
+            "version": _CACHE_TAG,
+            "layout": index_layout(len(texts)),
+            "sources": _pdf_sources(data_path),
+            "texts": texts,
+        }, f)
+    os.replace(tmp_texts_path, texts_path)
+
+
+def load_vector_store(data_dir):
+    """
+    Memory-map the persisted vector store if it is still up to date.
+    Returns (index, texts), or None when missing or stale. The index is
+    read-only; copy it before adding vectors.
+    """
+    data_path = Path(data_dir)
+    index_path = data_path / INDEX_FILE_NAME
+    texts_path = data_path / INDEX_TEXTS_FILE_NAME
+    if not index_path.exists() or not texts_path.exists():
+        return None
+
+    index_mtime = index_path.stat().st_mtime
+    if any(p.stat().st_mtime > index_mtime for p in data_path.glob("*.pdf")):
+        return None
+
+    with open(texts_path, "rb") as f:
+        stored = pickle.load(f)
+    if stored.get("version") != _CACHE_TAG or stored.get("sources") != _pdf_sources(data_path):
+        return None
+    # Rebuild when the index settings now call for a different layout
+    if stored.get("layout") != index_layout(len(stored["texts"])):
+        return None
+
+    # IO_FLAG_MMAP_IFC maps the vector codes of Flat / HNSW / SQ indexes
+    # straight from the file, so workers share them through the page cache.
+    # The returned index is READ-ONLY: add() on it (or on a clone_index of it,
+    # which still views the mapped codes) aborts the process. Every mutation
+    # path must take an owned copy first (see extend_vector_store).
+    index = faiss.read_index(str(index_path), faiss.IO_FLAG_MMAP_IFC)
+    if index.ntotal != len(stored["texts"]):
+        # Index and metadata come from different saves (e.g. a save in progress)
+        return None
+    return index, np.asarray(stored["texts"], dtype=object)
+
+
 def ingest(data_dir, embedding_model=None):
     """
     Ingest all PDFs from the data directory and build vector store.
@@ -75,20 +356,132 @@ def ingest(data_dir, embedding_model=None):
     if embedding_model is None:
         embedding_model = get_embedding_model()
     
-    chunks = load_all_pdfs_from_directory(data_dir)
-    index, texts = build_vector_store(chunks, embedding_model)
+    documents = load_all_pdfs_from_directory(data_dir, embedding_model)
+    index, texts = build_vector_store(documents, embedding_model)
     
-    return index, texts, len(chunks)
+    return index, texts, len(texts)
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def _encode_query(model, query):
+    """
+    Encode a query, memoized per (model, query) so swapping models never
+    serves stale embeddings. Returns raw float32 bytes so cached values
+    can't be mutated by callers.
+    """
+    return embed_texts([query], model).tobytes()
 
 
-def retrieve_context(query, model, index, texts, k=4):
-    """Retrieve relevant context from vector store for a query."""
+# Query encoding and FAISS search block in C code that releases the GIL, so
+# they run on worker threads rather than the event loop
+_search_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+class SearchBatcher:
+    """
+    Micro-batches concurrent FAISS searches. Callers await search() with a
+    single query; a background task gathers queued queries for the same
+    index and k, stacks them, and runs one index.search for the whole batch.
+    """
+
+    def __init__(self, max_batch=SEARCH_MAX_BATCH, max_wait=SEARCH_MAX_WAIT):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._loop = None
+        self._queue = None
+        self._worker = None
+        self._dispatches = set()
+
+    async def search(self, index, q_emb, k):
+        """Search one (1, dim) query; returns (distances, indices) like index.search."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+        future = loop.create_future()
+        await self._queue.put((index, q_emb, k, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Queries against different snapshots or k can't share a search call
+            groups = {}
+            for item in batch:
+                index, _, k, _ = item
+                groups.setdefault((id(index), k), []).append(item)
+
+            # Dispatch without awaiting so the next batch fills while this one runs
+            for items in groups.values():
+                task = loop.create_task(self._dispatch(items))
+                self._dispatches.add(task)
+                task.add_done_callback(self._dispatches.discard)
+
+    async def close(self):
+        """Cancel the background batching task (call on app shutdown)."""
+        tasks = list(self._dispatches)
+        if self._worker is not None and not self._worker.done():
+            tasks.append(self._worker)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop = self._queue = self._worker = None
+
+    async def _dispatch(self, items):
+        index, _, k, _ = items[0]
+        try:
+            queries = np.vstack([q_emb for _, q_emb, _, _ in items])
+            distances, indices = await asyncio.get_running_loop().run_in_executor(
+                _search_pool, index.search, queries, k
+            )
+        except Exception as e:
+            for _, _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for row, (_, _, _, future) in enumerate(items):
+            if not future.done():
+                future.set_result((distances[row:row + 1], indices[row:row + 1]))
+
+
+_search_batcher = SearchBatcher()
+
+
+async def close_search_batcher():
+    """Stop the shared search batcher's background task."""
+    await _search_batcher.close()
+
+
+async def retrieve_context(query, model, index, texts, k=4):
+    """
+    Retrieve relevant context from vector store for a query.
+    texts is the object array of chunk texts returned by build_vector_store.
+    """
     if len(texts) == 0:
         return "No documents available. Please upload PDF files first."
     
-    q_emb = model.encode([query], convert_to_numpy=True)
-    distances, indices = index.search(q_emb, k)
+    loop = asyncio.get_running_loop()
+    q_bytes = await loop.run_in_executor(_search_pool, _encode_query, model, query)
+    q_emb = np.frombuffer(q_bytes, dtype=np.float32).reshape(1, -1)
+    distances, indices = await _search_batcher.search(index, q_emb, k)
 
-    matched = [texts[i] for i in indices[0] if i < len(texts)]
+    # Embeddings and queries are unit-length, so inner-product scores are
+    # cosine similarities. FAISS pads with -1 when fewer than k vectors exist.
+    hits = indices[0]
+    matched = texts[hits[hits >= 0]].tolist()
 
     return "\n".join(matched)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from backend import rag
+
+
+DIM = 16
+
+
+class FakeEmbeddingModel:
+    """Stands in for SentenceTransformer; build_vector_store only needs the dimension."""
+
+    def get_sentence_embedding_dimension(self):
+        return DIM
+
+
+def _unit_vectors(n, seed):
+    vectors = np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("flat_threshold", [1000, 0], ids=["Flat", "HNSW32,SQ8"])
+def test_extend_persisted_vector_store(tmp_path, monkeypatch, flat_threshold):
+    """Save, memory-map, extend and search: the upload path after a restart."""
+    monkeypatch.setattr(rag, "FLAT_INDEX_THRESHOLD", flat_threshold)
+    embeddings = _unit_vectors(300, seed=0)
+    texts = [f"chunk {i}" for i in range(len(embeddings))]
+    index, texts = rag.build_vector_store([(texts, embeddings)], FakeEmbeddingModel())
+    rag.save_vector_store(index, texts, tmp_path)
+
+    loaded = rag.load_vector_store(tmp_path)
+    assert loaded is not None
+    loaded_index, loaded_texts = loaded
+
+    new_embeddings = _unit_vectors(5, seed=1)
+    new_texts = [f"new chunk {i}" for i in range(len(new_embeddings))]
+    index, texts = rag.extend_vector_store(loaded_index, loaded_texts, new_texts, new_embeddings)
+
+    assert index.ntotal == len(texts) == 305
+    assert loaded_index.ntotal == 300
+    _, hits = index.search(new_embeddings[:1], 4)
+    assert "new chunk 0" in texts[hits[0][hits[0] >= 0]].tolist()